@@ -19,14 +19,30 @@
 import cv2 as cv
 import argparse
 from argparse import ArgumentParser
+from collections import deque
 from datetime import datetime as dt
 from genericpath import isfile
+from math import ceil
+from motion_kernel import MotionCounterCV, motion_count
 from numpy import ndarray
 from os import mkdir
 from os.path import splitext, expanduser, isdir, join
-from queue import Queue
-from threading import Thread
-from typing import Tuple
+from queue import Empty, Full, Queue, SimpleQueue
+from subprocess import DEVNULL, PIPE, Popen
+from threading import Condition, Event, Thread
+from time import localtime, strftime, time
+from typing import Optional
+
+# thread CPU affinity is only supported on Linux
+try:
+    from os import sched_getaffinity, sched_setaffinity
+except ImportError:
+    sched_setaffinity = None
+# process niceness is only supported on Unix
+try:
+    from os import nice
+except ImportError:
+    nice = None
 
 # Standard Video Dimensions Sizes
 STD_DIMENSIONS = {
@@ -38,19 +54,172 @@ STD_DIMENSIONS = {
 }
 # Video Encoding, might require additional installs,
 # see http://www.fourcc.org/codecs.php
-# NOTE: mkv reccommended formatd
+# NOTE: mkv reccommended formatd; H264 can be hardware accelerated
 VIDEO_FORMAT = {
     "avi": cv.VideoWriter_fourcc(*"XVID"),
-    "mp4": cv.VideoWriter_fourcc(*"XVID"),
-    "mkv": cv.VideoWriter_fourcc(*"XVID"),
+    "mp4": cv.VideoWriter_fourcc(*"H264"),
+    "mkv": cv.VideoWriter_fourcc(*"H264"),
 }
+# Video Encoding falling back to, when the one above can't be opened (e.g. no
+# H264 encoder in stock opencv-python wheels)
+FALLBACK_VIDEO_FORMAT = cv.VideoWriter_fourcc(*"XVID")
+# Video Encoding for single-channel grayscale videos
+GRAY_VIDEO_FORMAT = cv.VideoWriter_fourcc(*"MJPG")
+# Scale factor applied to frames before motion detection: motion presence is a
+# coarse signal, so detecting on a 4x smaller frame (16x less pixels) suffices
+DETECTION_SCALE = 0.25
+# Minimum pixel intensity difference between frames to consider a pixel changed
+MOTION_THRESHOLD = 30
+# Minimum number of changed pixels (on the downsampled frame) for motion to be
+# detected
+MIN_MOTION_PIXELS = 50
+# Number of spare capture buffers kept for reuse, besides the ones needed for
+# frames in the ring & pre-roll
+CAPTURE_BUFFERS = 8
+# CPU cores (indexes among the available ones) capture & writer threads are
+# pinned to (see --pin-threads): the main thread gets the remaining ones
+GRABBER_CORE = 0
+WRITER_CORE = 2
+
+
+class Frame:
+    """
+    Frame grabbed by the FrameGrabber, along with its capture date & time
+
+    Parameters:
+    -----------
+    date_time: capture date & time string, overlaid on recorded frames
+    frame: captured frame (BGR or raw YUYV)
+    small: small grayscale frame prepared for motion detection, if any
+    """
+
+    # fixed attributes: no per-instance dict to allocate & look up
+    __slots__ = ("date_time", "frame", "small")
+
+    def __init__(self, date_time: str, frame: ndarray, small: ndarray) -> None:
+        self.date_time = date_time
+        self.frame = frame
+        self.small = small
+
+
+class FrameRing:
+    """
+    Fixed size ring of frames handed over from a single producer thread to a
+    single consumer thread: the producer may overwrite the oldest frame
+    rather than waiting for the consumer to catch up
+
+    Parameters:
+    -----------
+    size: number of frames the ring can hold
+    """
+
+    def __init__(self, size: int) -> None:
+        self.size = size
+        self.slots = [None] * size
+        # total number of frames put in & got from the ring: slot indexes are
+        # derived from these, their difference is the number of frames held
+        self.head = 0
+        self.tail = 0
+        # guards head & tail, waking up the thread waiting on the other end
+        self.cond = Condition()
+        # set once the consumer stops getting frames
+        self.closed = False
+
+    def put(
+        self, item: Optional[Frame], overwrite: bool = False
+    ) -> Optional[Frame]:
+        """
+        Put frame in the ring: if the ring is full either overwrite the oldest
+        frame (which is returned) or wait for the consumer to get one
+        """
+        dropped = None
+        with self.cond:
+            if self.head - self.tail == self.size:
+                if overwrite:
+                    # drop oldest frame
+                    dropped = self.slots[self.tail % self.size]
+                    self.tail += 1
+                else:
+                    while self.head - self.tail == self.size:
+                        # nobody would ever make room
+                        if self.closed:
+                            return None
+                        self.cond.wait()
+            self.slots[self.head % self.size] = item
+            self.head += 1
+            self.cond.notify()
+        return dropped
 
-# frames captured & queued, waiting to be processed
-frames = Queue(10000)
+    def close(self) -> None:
+        """
+        Signal the producer that the consumer stopped getting frames, waking
+        it up if waiting for room in the ring
+        """
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def full(self) -> bool:
+        """
+        Whether the ring is full: only reliable from the producer thread, as
+        the consumer can only make room in the meantime
+        """
+        return self.head - self.tail == self.size
+
+    def get(self) -> Optional[Frame]:
+        """
+        Get oldest frame from the ring, waiting for one if empty
+        """
+        with self.cond:
+            while self.head == self.tail:
+                self.cond.wait()
+            index = self.tail % self.size
+            item = self.slots[index]
+            self.slots[index] = None  # don't keep a reference to the frame
+            self.tail += 1
+            self.cond.notify()
+            return item
+
+
+# frames captured & waiting to be processed: kept few to bound both memory
+# usage and capture-to-detection latency
+frames = FrameRing(2)
+# set while the main thread is looking for motion, cleared while it's
+# recording: frames are prepared for motion detection only when set
+detecting = Event()
+detecting.set()
+# capture buffers of frames no thread needs anymore, handed back to the
+# FrameGrabber to decode new frames into
+free_bufs = SimpleQueue()
+# capture buffers kept in free_bufs at most, further ones are left to be
+# freed: frames queued while the encoder lags behind would otherwise stay
+# allocated for good (pre-roll frames are added by the FrameGrabber)
+max_free_bufs = frames.size + CAPTURE_BUFFERS
+# date & time overlay string only changes once per second: cached along with
+# the second it was formatted for
+_ts_sec = -1
+_ts_str = ""
 
 
 def get_args() -> argparse.Namespace:
     argparser = ArgumentParser(allow_abbrev=False)
+    argparser.add_argument(
+        "-b",
+        "--before",
+        type=int,
+        metavar="<sec>",
+        help=(
+            "also record <sec> seconds before motion detected"
+            " (defaults to 2 seconds)"
+        ),
+        default=2,
+    )
+    argparser.add_argument(
+        "-c",
+        "--opencl",
+        action="store_true",
+        help="run motion detection on OpenCL device (GPU), if available",
+    )
     argparser.add_argument(
         "-d",
         "--duration",
@@ -62,6 +231,16 @@ def get_args() -> argparse.Namespace:
         ),
         default=3,
     )
+    argparser.add_argument(
+        "-e",
+        "--encoder",
+        type=str,
+        metavar="<codec>",
+        help=(
+            "encode video piping frames to ffmpeg with the given (hardware)"
+            " encoder, e.g. h264_v4l2m2m or h264_nvenc"
+        ),
+    )
     argparser.add_argument(
         "-f",
         "--fps",
@@ -71,12 +250,44 @@ def get_args() -> argparse.Namespace:
         choices=[5, 10, 30, 60],
         default=10,
     )
+    argparser.add_argument(
+        "-g",
+        "--grayscale",
+        action="store_true",
+        help="record grayscale video (3x less data to encode & store)",
+    )
+    argparser.add_argument(
+        "-i",
+        "--detect-interval",
+        type=int,
+        metavar="<n>",
+        help="look for motion every <n> frames (defaults to every frame)",
+        default=1,
+    )
+    argparser.add_argument(
+        "-m",
+        "--mjpg",
+        action="store_true",
+        help=(
+            "capture MJPG stream from camera, allowing higher framerates at"
+            " high resolutions"
+        ),
+    )
     argparser.add_argument(
         "-o",
         "--no-overlay",
         action="store_true",
         help="disable date & time overlay on video frames",
     )
+    argparser.add_argument(
+        "-p",
+        "--pin-threads",
+        action="store_true",
+        help=(
+            "pin capture & writer threads to their own CPU cores, motion"
+            " detection to the remaining ones"
+        ),
+    )
     argparser.add_argument(
         "-q", "--quiet", action="store_true", help="mute output"
     )
@@ -91,6 +302,22 @@ def get_args() -> argparse.Namespace:
         choices=list(STD_DIMENSIONS),
         default="720p",
     )
+    argparser.add_argument(
+        "-s",
+        "--segment",
+        type=int,
+        metavar="<sec>",
+        help="split recorded video in <sec> seconds long files (needs -e)",
+    )
+    argparser.add_argument(
+        "-t",
+        "--ffmpeg-overlay",
+        action="store_true",
+        help=(
+            "let ffmpeg draw date & time overlay (needs -e): shows encoding"
+            " rather than capture time"
+        ),
+    )
     argparser.add_argument(
         "-v",
         "--video",
@@ -98,7 +325,68 @@ def get_args() -> argparse.Namespace:
         metavar="<path_to_vid>",
         help="path of the video file to use rather than video capture",
     )
-    return argparser.parse_args()
+    args = argparser.parse_args()
+    if args.before < 0:
+        argparser.error("argument -b/--before must not be negative")
+    if args.duration < 0:
+        argparser.error("argument -d/--duration must not be negative")
+    if args.detect_interval < 1:
+        argparser.error("argument -i/--detect-interval must be positive")
+    if args.segment is not None and args.segment < 1:
+        argparser.error("argument -s/--segment must be positive")
+    # segmentation & ffmpeg overlay are performed by ffmpeg
+    if args.segment and not args.encoder:
+        argparser.error("argument -s/--segment requires -e/--encoder")
+    if args.ffmpeg_overlay and not args.encoder:
+        argparser.error("argument -t/--ffmpeg-overlay requires -e/--encoder")
+    return args
+
+
+def now_str() -> str:
+    """
+    Current date & time string, formatted only when a new second begins
+    """
+    global _ts_sec, _ts_str
+    sec = int(time())
+    if sec != _ts_sec:
+        _ts_str = strftime("%Y-%m-%d %H:%M:%S", localtime(sec))
+        _ts_sec = sec
+    return _ts_str
+
+
+def release(item: Frame) -> None:
+    """
+    Hand frame capture buffer back to the FrameGrabber for reuse: call once
+    the frame is dropped or written, by the thread holding it last
+    """
+    if free_bufs.qsize() < max_free_bufs:
+        free_bufs.put(item.frame)
+
+
+def pin_thread(core: Optional[int], niceness: int = 0) -> None:
+    """
+    Pin calling thread to a single CPU core (among the available ones), or to
+    the cores grabber & writer threads aren't pinned to if core is None, and
+    change its niceness: on Linux both apply to the calling thread only
+    """
+    if sched_setaffinity is not None:
+        cores = sorted(sched_getaffinity(0))
+        if core is None:
+            # threads spawned by the caller (e.g. Numba workers) inherit its
+            # affinity: leave them every core not taken, if any
+            taken = {
+                cores[GRABBER_CORE % len(cores)],
+                cores[WRITER_CORE % len(cores)],
+            }
+            sched_setaffinity(0, set(cores) - taken or set(cores))
+        else:
+            sched_setaffinity(0, {cores[core % len(cores)]})
+    if niceness and nice is not None:
+        try:
+            nice(niceness)
+        except PermissionError:
+            # raising priority requires privileges: keep default one
+            pass
 
 
 class FrameGrabber(Thread):
@@ -110,10 +398,43 @@ class FrameGrabber(Thread):
     video: video file path, if None use camera input
     resolution: resolution of the video capture
     fps: framerate of the videocapture
+    mjpg: request MJPG rather than raw YUYV frames from the camera
+    interval: prepare one frame every interval frames for motion detection
+    before: seconds of frames kept in memory to be recorded before motion
+    pin: pin thread to its own CPU core
     """
 
-    def __init__(self, video: str, resolution: str, fps: int) -> None:
+    def __init__(
+        self,
+        video: str,
+        resolution: str,
+        fps: int,
+        mjpg: bool,
+        interval: int,
+        before: int,
+        pin: bool,
+    ) -> None:
         Thread.__init__(self)
+        self.pin = pin
+        # scene changes much slower than framerate: only every interval-th
+        # frame needs to be prepared for motion detection
+        self.interval = interval
+        self._count = 0
+        # live capture must never block on a full queue (frames would lag
+        # behind), while video files are read as fast as they are consumed
+        self.live = not video
+        # full-size grayscale frame is only an intermediate step before
+        # downsampling: reuse the same buffer across frames
+        self._gray = None
+        # whether frames are captured as raw YUYV rather than BGR, the
+        # (height, width, 2) shape raw frames are viewed as and the shape
+        # they're decoded with
+        self.yuyv = False
+        self._yuyv_shape = None
+        self._raw_shape = None
+        # if OpenCL is available & enabled (see --opencl) prepare frames for
+        # motion detection as cv.UMat, so that they never leave the device
+        self.opencl = cv.ocl.useOpenCL()
         # if video option is provided, then use video resource instead of
         # camera input
         if video:
@@ -126,6 +447,14 @@ class FrameGrabber(Thread):
         else:
             # define camera input
             self.cap = cv.VideoCapture(0)
+            # pixel format must be set before frame size & framerate, which
+            # may depend on it: MJPG stream sustains higher framerates at high
+            # resolutions over USB (frames are decoded to BGR by the backend),
+            # while raw YUYV frames allow to use their luma plane as is for
+            # motion detection, converting to BGR only frames actually
+            # recorded
+            fourcc = cv.VideoWriter_fourcc(*("MJPG" if mjpg else "YUYV"))
+            self.cap.set(cv.CAP_PROP_FOURCC, fourcc)
             # get frame dimensions
             width, height = STD_DIMENSIONS[resolution]
             # set capture frame width & height
@@ -133,20 +462,123 @@ class FrameGrabber(Thread):
             self.cap.set(cv.CAP_PROP_FRAME_HEIGHT, height)
             # set capture framerate
             self.cap.set(cv.CAP_PROP_FPS, fps)
+            if not mjpg:
+                # ask backend for raw YUYV frames
+                self.cap.set(cv.CAP_PROP_CONVERT_RGB, 0)
+                self.yuyv = int(self.cap.get(cv.CAP_PROP_FOURCC)) == fourcc
+                if self.yuyv:
+                    # V4L2 backend hands raw frames over as a single row of
+                    # bytes: probe one to check it's exactly a 2 bytes per
+                    # pixel YUYV image, to be viewed as (height, width, 2)
+                    self._yuyv_shape = (
+                        int(self.cap.get(cv.CAP_PROP_FRAME_HEIGHT)),
+                        int(self.cap.get(cv.CAP_PROP_FRAME_WIDTH)),
+                        2,
+                    )
+                    ok, probe = self.cap.read()
+                    self.yuyv = ok and probe.size == (
+                        self._yuyv_shape[0] * self._yuyv_shape[1] * 2
+                    )
+                    if self.yuyv:
+                        self._raw_shape = probe.shape
+                if not self.yuyv:
+                    # camera doesn't support YUYV (or hands over frames of
+                    # unexpected size): let backend convert to BGR
+                    self.cap.set(cv.CAP_PROP_CONVERT_RGB, 1)
+        # frames kept in memory as pre-roll need capture buffers of their own
+        global max_free_bufs
+        max_free_bufs += int(before * self.cap.get(cv.CAP_PROP_FPS))
 
     def run(self) -> None:
         """
         Run thread
         """
         global frames
-        while self.cap.isOpened():
-            _, frame = self.cap.read()
-            frames.put(
-                {
-                    "date_time": dt.now().strftime("%Y-%m-%d %H:%M:%S"),
-                    "frame": frame,
-                }
-            )
+        if self.pin:
+            # raise priority so that camera frames aren't dropped because of
+            # scheduler pressure
+            pin_thread(core=GRABBER_CORE, niceness=-5)
+        try:
+            # main thread closes the ring once it stops consuming frames
+            while self.cap.isOpened() and not frames.closed:
+                # grabbing only advances to the next frame, while retrieving
+                # it also decodes it: on live capture, if the main thread is
+                # behind, drop the frame before paying for its decoding
+                if not self.cap.grab():
+                    break
+                if self.live and frames.full():
+                    continue
+                frame = self._retrieve()
+                if frame is None:
+                    break
+                prepare = (
+                    detecting.is_set() and self._count % self.interval == 0
+                )
+                self._count += 1
+                item = Frame(
+                    date_time=now_str(),
+                    frame=frame,
+                    small=self._prepare(frame) if prepare else None,
+                )
+                # if the consumer falls behind drop the oldest frame on live
+                # capture
+                dropped = frames.put(item, overwrite=self.live)
+                if dropped is not None:
+                    release(dropped)
+        finally:
+            # video file ended, camera disconnected, capture failed or the
+            # main thread stopped: release it and signal the end of capture
+            # to the main thread (never overwritten) even on error
+            self.cap.release()
+            frames.put(None)
+
+    def _retrieve(self) -> Optional[ndarray]:
+        # decode frame into a buffer released by the other threads, sparing a
+        # full-frame allocation per frame: if none is free (e.g. while
+        # recording) OpenCV allocates a new one, as it does if frame size
+        # changed
+        try:
+            buf = free_bufs.get_nowait()
+        except Empty:
+            buf = None
+        if buf is not None and self.yuyv:
+            # back to the row of bytes the backend decodes into
+            buf = buf.reshape(self._raw_shape)
+        ok, frame = self.cap.retrieve(buf)
+        # on failure the destination buffer is handed back as is, holding a
+        # stale frame
+        if not ok:
+            return None
+        # raw YUYV frame is a row of bytes: view it as a 2 channels image
+        if self.yuyv:
+            frame = frame.reshape(self._yuyv_shape)
+        return frame
+
+    def _prepare(self, frame: ndarray) -> ndarray:
+        # grayscale, downsample & blur once at ingest, so that motion
+        # detection works on small single-channel frames only
+        if self.opencl:
+            frame = cv.UMat(frame)
+        # a single channel is enough to detect motion: no weighted sum of the
+        # three BGR channels is needed
+        if self.yuyv:
+            # luma (Y) is the first of the two YUYV channels
+            self._gray = cv.extractChannel(frame, 0, dst=self._gray)
+        else:
+            # green has the highest signal-to-noise ratio of BGR channels
+            self._gray = cv.extractChannel(frame, 1, dst=self._gray)
+        small = cv.resize(
+            self._gray,
+            None,
+            fx=DETECTION_SCALE,
+            fy=DETECTION_SCALE,
+            interpolation=cv.INTER_AREA,
+        )
+        # small frame is queued, hence it's freshly allocated by resize, but
+        # it can be blurred in place: a box filter suppresses noise as well as
+        # a Gaussian for motion detection, with integer-only arithmetic
+        cv.boxFilter(small, -1, (5, 5), dst=small)
+        return small
 
     def stop(self) -> None:
         """
@@ -155,31 +587,152 @@ class FrameGrabber(Thread):
         self.cap.release()
 
 
-# main thread
-class Main(Thread):
+class FFmpegWriter:
     """
-    Main thread class
+    Video writer piping raw frames to an ffmpeg process, so that encoding can
+    be offloaded to hardware encoders (V4L2 M2M, NVENC...) OpenCV doesn't
+    reach: exposes the same interface as cv.VideoWriter
+
+    Parameters:
+    -----------
+    filename: output video file path (strftime pattern if segment is set)
+    encoder: ffmpeg video encoder
+    fps: framerate of the video
+    dims: (width, height) of the video frames
+    grayscale: whether frames are single-channel grayscale rather than BGR
+    segment: split output in files of segment seconds each, if not None
+    overlay: let ffmpeg draw date & time overlay on video frames
+    """
+
+    def __init__(
+        self,
+        filename: str,
+        encoder: str,
+        fps: float,
+        dims: tuple,
+        grayscale: bool,
+        segment: int,
+        overlay: bool,
+    ) -> None:
+        # raw frames read from stdin
+        args = [
+            "ffmpeg",
+            "-loglevel",
+            "error",
+            "-y",
+            "-f",
+            "rawvideo",
+            "-pix_fmt",
+            "gray" if grayscale else "bgr24",
+            "-s",
+            f"{dims[0]}x{dims[1]}",
+            "-r",
+            str(fps),
+            "-i",
+            "-",
+        ]
+        if overlay:
+            # date & time drawn by ffmpeg filter graph when frames are encoded
+            args += [
+                "-vf",
+                "drawtext=text='%{localtime\\:%F %X}'"
+                ":x=10:y=15:fontsize=32:fontcolor=white",
+            ]
+        # encoded output
+        args += ["-c:v", encoder, "-b:v", "4M"]
+        if segment:
+            # the same ffmpeg process splits output in files named after
+            # their start date & time, rather than reopening a writer (and
+            # reinitializing the encoder) for each file
+            args += [
+                "-f",
+                "segment",
+                "-segment_time",
+                str(segment),
+                "-reset_timestamps",
+                "1",
+                "-strftime",
+                "1",
+            ]
+        args.append(filename)
+        try:
+            self.proc = Popen(args, stdin=PIPE, stdout=DEVNULL)
+        except OSError:
+            # ffmpeg not installed (or not executable): isOpened reports it
+            self.proc = None
+
+    def isOpened(self) -> bool:
+        """
+        Whether ffmpeg is still running
+        """
+        return self.proc is not None and self.proc.poll() is None
+
+    def write(self, frame: ndarray) -> None:
+        """
+        Write frame to ffmpeg standard input
+        """
+        # frames are contiguous, hence their buffer is written as is
+        try:
+            self.proc.stdin.write(frame.data)
+        except BrokenPipeError:
+            # ffmpeg exited: isOpened reports it
+            pass
+
+    def release(self) -> None:
+        """
+        Close ffmpeg standard input, waiting for it to finalize the video
+        """
+        if self.proc is None:
+            return
+        # closing flushes buffered frames, failing if ffmpeg already exited
+        try:
+            self.proc.stdin.close()
+        except BrokenPipeError:
+            pass
+        self.proc.wait()
+
+
+class FrameWriter(Thread):
+    """
+    FrameWriter thread class: frames queued by the main thread are encoded
+    and written to the output video file, so that encoding never stalls
+    motion detection
 
     Parameters:
     -----------
     cap: instance of cv.VideoCapture resource
-    duration: integer number of seconds to keep recording after motion detected
+    yuyv: whether queued frames are raw YUYV, to be converted to BGR
+    grayscale: record single-channel grayscale video
+    encoder: ffmpeg encoder to pipe frames to, if None use cv.VideoWriter
+    segment: split output in files of segment seconds each (ffmpeg only)
+    ffmpeg_overlay: date & time overlay drawn by ffmpeg (ffmpeg only)
+    duration: integer number of seconds recorded after motion detected
+    before: integer number of seconds recorded before motion detected
     no_overlay: disables date & time overlay on video frames
     quiet: wheter to be quiet (no prints) or to be verbose (output prints)
+    pin: pin thread to its own CPU core
     """
 
     def __init__(
         self,
         cap: cv.VideoCapture,
+        yuyv: bool,
+        grayscale: bool,
+        encoder: str,
+        segment: int,
+        ffmpeg_overlay: bool,
         duration: int,
+        before: int,
         no_overlay: bool,
         quiet: bool,
+        pin: bool,
     ) -> None:
         Thread.__init__(self)
-        # keep recording for ``duration'' seconds after motion been detected
-        self.duration = duration
-        # disable date & time overlay on video frames
-        self.no_overlay = no_overlay
+        self.pin = pin
+        self.yuyv = yuyv
+        self.grayscale = grayscale
+        # disable date & time overlay on video frames, or leave it to ffmpeg
+        self.no_overlay = no_overlay or ffmpeg_overlay
         # output video directory
         video_dir = join(expanduser("~"), "video")
         if not isdir(video_dir):  # if directory doesn't exits, create it
@@ -189,24 +742,91 @@ class Main(Thread):
             video_dir, f"{dt.today().strftime('%Y-%m-%d_%H:%M:%S')}.mkv"
         )
         # retrieve video format chosen based on extension
-        video_format = self._get_video_format(filename)
+        video_format = (
+            GRAY_VIDEO_FORMAT
+            if grayscale
+            else self._get_video_format(filename)
+        )
         # set VideoWriter resolution & framerate based on video capture values
         dims = (
             int(cap.get(cv.CAP_PROP_FRAME_WIDTH)),
             int(cap.get(cv.CAP_PROP_FRAME_HEIGHT)),
         )
         self.fps = cap.get(cv.CAP_PROP_FPS)
-        self.writer = cv.VideoWriter(filename, video_format, self.fps, dims)
+        # need to convert duration of recording in number of frames by
+        # multiplying duration in seconds by frames per seconds value
+        self.burst = int(duration * self.fps)
+        # recorded frames are handed over by the main thread in batches of
+        # one second, rather than one at a time
+        self.batch_size = max(1, int(self.fps))
+        # batches waiting to be written: room for a whole recording burst
+        # (whose last batch is partial with fractional fps), plus the
+        # pre-roll queued as one more batch, so that the encoder can lag
+        # behind for the entire burst before frames get dropped
+        batches = ceil(self.burst / self.batch_size) + (1 if before else 0)
+        self.queue = Queue(max(2, batches))
+        if encoder:
+            if segment:
+                # each segment is named by ffmpeg after its start date & time
+                filename = join(video_dir, "%Y-%m-%d_%H:%M:%S.mkv")
+            self.writer = FFmpegWriter(
+                filename,
+                encoder,
+                self.fps,
+                dims,
+                grayscale,
+                segment,
+                ffmpeg_overlay and not no_overlay,
+            )
+        else:
+            self.writer = self._open_writer(
+                filename, video_format, dims, grayscale
+            )
+            if not self.writer.isOpened():
+                self.writer = self._open_writer(
+                    filename, FALLBACK_VIDEO_FORMAT, dims, grayscale
+                )
+        # nothing would ever be recorded: don't start capturing at all
+        if not self.writer.isOpened():
+            print("Unable to open video writer")
+            exit()
         # if not in quiet mode print resolution & framerate
         if not quiet:
             print(
                 "Starting recording\n"
-                "├─ Resolution: "
-                f"{int(cap.get(cv.CAP_PROP_FRAME_WIDTH))}x"
-                f"{int(cap.get(cv.CAP_PROP_FRAME_HEIGHT))}\n"
+                f"├─ Resolution: {dims[0]}x{dims[1]}\n"
                 f"└─ Frames per second: {int(self.fps)}"
             )
-        self.prev_frame = None  # initialize previous frame to none
+
+    def _open_writer(
+        self, filename: str, video_format: int, dims: tuple, grayscale: bool
+    ) -> cv.VideoWriter:
+        # hardware acceleration properties require OpenCV >= 4.5.2: older
+        # versions only get a software encoder
+        if not hasattr(cv, "VIDEOWRITER_PROP_HW_ACCELERATION"):
+            return cv.VideoWriter(
+                filename,
+                cv.CAP_FFMPEG,
+                video_format,
+                self.fps,
+                dims,
+                not grayscale,
+            )
+        # prefer hardware accelerated encoding (VA-API, NVENC, V4L2 M2M...)
+        # via FFmpeg backend, falling back to software if none is available
+        return cv.VideoWriter(
+            filename,
+            cv.CAP_FFMPEG,
+            video_format,
+            self.fps,
+            dims,
+            params=[
+                cv.VIDEOWRITER_PROP_HW_ACCELERATION,
+                cv.VIDEO_ACCELERATION_ANY,
+                cv.VIDEOWRITER_PROP_IS_COLOR,
+                int(not grayscale),
+            ],
+        )
 
     def _get_video_format(self, filename: str) -> cv.VideoWriter_fourcc:
         _, ext = splitext(filename)
@@ -216,34 +836,44 @@ class Main(Thread):
         # default to mkv in case filename has no extension
         return VIDEO_FORMAT["mkv"]
 
-    def _next_frame(self):
-        # current frame becomes previous frame and next frame is pulled from
-        # the ``frames'' queue
-        self.prev_frame = self.frame
-        self.frame = frames.get()
-
-    def _motion_detected(self) -> Tuple[ndarray, ...]:
-        proc_frame = cv.absdiff(self.prev_frame["frame"], self.frame["frame"])
-        proc_frame = cv.cvtColor(proc_frame, cv.COLOR_BGR2GRAY)
-        proc_frame = cv.GaussianBlur(proc_frame, (21, 21), 0)
-        proc_frame = cv.threshold(proc_frame, 30, 255, cv.THRESH_BINARY)[1]
-        proc_frame = cv.dilate(proc_frame, None, iterations=3)
-        contours, _ = cv.findContours(
-            proc_frame, cv.RETR_EXTERNAL, cv.CHAIN_APPROX_SIMPLE
-        )
-        return contours
+    def run(self) -> None:
+        """
+        Run thread
+        """
+        if self.pin:
+            pin_thread(core=WRITER_CORE)
+        # start writing loop which ends when writer is released or when the
+        # main thread signals there's nothing left to write
+        try:
+            while self.writer.isOpened():
+                batch = self.queue.get()
+                if batch is None:
+                    break
+                for item in batch:
+                    self._write_frame(item)
+                    release(item)
+        finally:
+            self.writer.release()
 
-    def _write_frame(self) -> None:
-        # frame it is copied to avoid writing date on the frame needed for
-        # frame comparison in motion detection
-        cloned_frame = self.frame["frame"].copy()
+    def _write_frame(self, item: Frame) -> None:
+        frame = item.frame
+        if self.grayscale:
+            # luma (Y) is the first of the two YUYV channels
+            if self.yuyv:
+                frame = cv.extractChannel(frame, 0)
+            else:
+                frame = cv.cvtColor(frame, cv.COLOR_BGR2GRAY)
+        elif self.yuyv:
+            frame = cv.cvtColor(frame, cv.COLOR_YUV2BGR_YUYV)
+        # motion detection only uses the separate small grayscale frame, so
+        # date & time can be drawn in place without copying the frame
         # if no_overlay option is selected, date and time overlay on frame is
         # disabled
         if not self.no_overlay:
             # write date and time on frame before writing it to output file
-            cloned_frame = cv.putText(
-                cloned_frame,  # frame to write on
-                self.frame["date_time"],  # displayed text
+            cv.putText(
+                frame,  # frame to write on
+                item.date_time,  # displayed text
                 (10, 40),  # position on frame
                 cv.FONT_HERSHEY_DUPLEX,  # font
                 1,  # font size
@@ -251,47 +881,204 @@ class Main(Thread):
                 2,  # stroke
             )
         # write frame to output file
-        self.writer.write(cloned_frame)
+        self.writer.write(frame)
+
+    def stop(self) -> None:
+        """
+        Stop thread safely releasing video writer
+        """
+        self.writer.release()
+
+
+# main thread
+class Main(Thread):
+    """
+    Main thread class
+
+    Parameters:
+    -----------
+    writer: FrameWriter thread frames to record are handed to
+    duration: integer number of seconds to keep recording after motion detected
+    before: integer number of seconds recorded before motion detected
+    opencl: whether frames prepared for motion detection are cv.UMat
+    quiet: wheter to be quiet (no prints) or to be verbose (output prints)
+    pin: pin thread to its own CPU core
+    """
+
+    def __init__(
+        self,
+        writer: FrameWriter,
+        duration: int,
+        before: int,
+        opencl: bool,
+        quiet: bool,
+        pin: bool,
+    ) -> None:
+        Thread.__init__(self)
+        self.pin = pin
+        self.quiet = quiet
+        # OpenCL frames are processed by OpenCV on the OpenCL device
+        self._motion_count = MotionCounterCV() if opencl else motion_count
+        self.writer = writer
+        # keep recording for ``duration'' seconds after motion been detected
+        self.duration = duration
+        self.fps = writer.fps
+        # frames recorded after motion detected & handed over at once: the
+        # writer queue is sized after them
+        self.burst = writer.burst
+        self.batch_size = writer.batch_size
+        # most recent frames, recorded before the frame motion is detected in
+        # (pre-roll), so that the beginning of events isn't lost
+        self.preroll = deque(maxlen=int(before * self.fps))
+        # initialize previous frames prepared for motion detection to none
+        self.prev2_small = None
+        self.prev_small = None
+
+    def _motion_detected(self) -> bool:
+        small = self.frame.small
+        # frames skipped by the detect interval or grabbed while recording
+        # aren't prepared for motion detection
+        if small is None:
+            return False
+        # prepared frames shift back by one (current becomes previous)
+        prev2, prev = self.prev2_small, self.prev_small
+        self.prev2_small, self.prev_small = prev, small
+        # wait for three prepared frames before looking for motion
+        if prev2 is None:
+            return False
+        # frames are already grayscale, downsampled & blurred by the
+        # FrameGrabber; motion is a yes/no decision, so it is enough to count
+        # the pixels changed across the last three prepared frames
+        changed = self._motion_count(prev2, prev, small, MOTION_THRESHOLD)
+        return changed > MIN_MOTION_PIXELS
+
+    def _write_batch(self, batch: list) -> None:
+        # hand frames over to the writer thread (which converts & stamps
+        # them), dropping them if the encoder can't keep up rather than
+        # stalling motion detection
+        try:
+            self.writer.queue.put_nowait(batch)
+        except Full:
+            # dropped frames leave a gap in the recording: report it
+            if not self.quiet:
+                print(f"Encoder falling behind: dropped {len(batch)} frames")
+            for item in batch:
+                release(item)
 
     def run(self) -> None:
         global frames
-        # grab a couple of frames from the the que and enter main loop
-        self.prev_frame = frames.get()
-        self.frame = frames.get()
-        # start writing loop which ends only when writer is released
-        while self.writer.isOpened():
-            if self._motion_detected():
-                # if motion is detected record for <duration> seconds:
-                # need to convert duration of recording in number of frames by
-                # multiplying duration in seconds by frames per seconds value
-                for _ in range(int(self.duration * self.fps)):
-                    self._write_frame()
-                    self._next_frame()
-            else:
-                # if motion is not detected keep pulling frames from queue
-                self._next_frame()
+        if self.pin:
+            # motion detection workers share the cores left to this thread
+            pin_thread(core=None)
+        # bind what's looked up on every frame to locals
+        get = frames.get
+        motion_detected = self._motion_detected
+        write_batch = self._write_batch
+        burst = self.burst
+        batch_size = self.batch_size
+        preroll = self.preroll
+        try:
+            # grab a frame from the the que and enter main loop
+            self.frame = get()
+            # start main loop which ends when capture ends (None frame is
+            # got) or when writer thread is stopped
+            while self.frame is not None and self.writer.is_alive():
+                if motion_detected():
+                    # if motion is detected record for <duration> seconds
+                    # (``burst'' frames); meanwhile the FrameGrabber can skip
+                    # motion detection prep
+                    detecting.clear()
+                    if preroll:
+                        write_batch(list(preroll))
+                        preroll.clear()
+                    batch = []
+                    for _ in range(burst):
+                        batch.append(self.frame)
+                        if len(batch) == batch_size:
+                            write_batch(batch)
+                            batch = []
+                        self.frame = get()
+                        if self.frame is None:
+                            break
+                    if batch:
+                        write_batch(batch)
+                    # frames prepared before recording are stale by now
+                    self.prev2_small = None
+                    self.prev_small = None
+                    detecting.set()
+                else:
+                    # if motion is not detected keep pulling frames from
+                    # queue, keeping the most recent ones as pre-roll (the
+                    # oldest one is dropped once it's full)
+                    if preroll.maxlen:
+                        if len(preroll) == preroll.maxlen:
+                            release(preroll[0])
+                        preroll.append(self.frame)
+                    else:
+                        release(self.frame)
+                    self.frame = get()
+        finally:
+            # no more frames are consumed: stop the FrameGrabber, which may be
+            # waiting for room in the ring
+            frames.close()
+            # let the writer thread write remaining frames and finalize the
+            # video: waiting for room in its queue only as long as it's alive
+            while self.writer.is_alive():
+                try:
+                    self.writer.queue.put(None, timeout=1)
+                    break
+                except Full:
+                    pass
 
     def stop(self) -> None:
         """
-        Stop thread safely releasing video writer
+        Stop thread safely stopping the frame writer
         """
-        self.writer.release()
+        self.writer.stop()
 
 
 def main() -> None:
     args = get_args()  # get command line arguments
+    # OpenCL is opt-in, as it's not beneficial (or reliable) on every
+    # platform, e.g. ARM boards
+    cv.ocl.setUseOpenCL(args.opencl)
     grabber = FrameGrabber(
-        video=args.video, resolution=args.resolution, fps=args.fps
+        video=args.video,
+        resolution=args.resolution,
+        fps=args.fps,
+        mjpg=args.mjpg,
+        interval=args.detect_interval,
+        before=args.before,
+        pin=args.pin_threads,
     )
-    m = Main(
+    writer = FrameWriter(
         cap=grabber.cap,
+        yuyv=grabber.yuyv,
+        grayscale=args.grayscale,
+        encoder=args.encoder,
+        segment=args.segment,
+        ffmpeg_overlay=args.ffmpeg_overlay,
         duration=args.duration,
+        before=args.before,
         no_overlay=args.no_overlay,
         quiet=args.quiet,
+        pin=args.pin_threads,
+    )
+    m = Main(
+        writer=writer,
+        duration=args.duration,
+        before=args.before,
+        opencl=grabber.opencl,
+        quiet=args.quiet,
+        pin=args.pin_threads,
     )
     grabber.start()
+    # writer must be running before main thread, which loops while the
+    # writer is alive
+    writer.start()
     m.start()
     grabber.join()
+    writer.join()
     m.join()
 
 
@@ -0,0 +1,75 @@
+# BombusCV: python OpenCV motion detection/recording tool developed for
+# research on Bumblebees
+# Copyright (C) 2022 Marco Radocchia
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see https://www.gnu.org/licenses/.
+
+import cv2 as cv
+from numpy import ndarray
+
+# numba is optional: if not installed fall back to the OpenCV implementation
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+
+class MotionCounterCV:
+    """
+    Count pixels whose intensity changed more than thr both between prev2
+    and prev and between prev and cur grayscale frames (three-frame temporal
+    difference) using OpenCV, reusing intermediate buffers across calls:
+    frames may also be cv.UMat, in which case the computation runs on the
+    OpenCL device
+    """
+
+    def __init__(self) -> None:
+        # thresholded differences, allocated on first call
+        self._diff1 = None
+        self._diff2 = None
+
+    def __call__(
+        self, prev2: ndarray, prev: ndarray, cur: ndarray, thr: int
+    ) -> int:
+        self._diff1 = cv.absdiff(prev, prev2, dst=self._diff1)
+        cv.threshold(self._diff1, thr, 255, cv.THRESH_BINARY, dst=self._diff1)
+        self._diff2 = cv.absdiff(cur, prev, dst=self._diff2)
+        cv.threshold(self._diff2, thr, 255, cv.THRESH_BINARY, dst=self._diff2)
+        cv.bitwise_and(self._diff1, self._diff2, dst=self._diff1)
+        return cv.countNonZero(self._diff1)
+
+
+if njit is not None:
+
+    @njit(parallel=True, cache=True)
+    def motion_count(
+        prev2: ndarray, prev: ndarray, cur: ndarray, thr: int
+    ) -> int:
+        """
+        Count pixels whose intensity changed more than thr both between prev2
+        and prev and between prev and cur grayscale frames (three-frame
+        temporal difference): absdiffs, thresholds & count fused in one pass
+        """
+        n = 0
+        for i in prange(cur.shape[0]):
+            for j in range(cur.shape[1]):
+                if (
+                    abs(int(prev[i, j]) - int(prev2[i, j])) > thr
+                    and abs(int(cur[i, j]) - int(prev[i, j])) > thr
+                ):
+                    n += 1
+        return n
+
+else:
+    motion_count = MotionCounterCV()